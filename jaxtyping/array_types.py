@@ -17,15 +17,42 @@
 # IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+# Annotations in this file are only for type checkers, and are never evaluated at
+# runtime. This saves building a number of `typing` objects on import.
+from __future__ import annotations
+
 import functools as ft
-from typing import Any, Dict, List, NoReturn, Optional, Tuple, Union
-from typing_extensions import Literal
+from typing import TYPE_CHECKING
 
+import jax
 import jax.numpy as jnp
 
 from .decorator import storage
 
 
+if TYPE_CHECKING:
+    from typing import (
+        Any,
+        Callable,
+        ClassVar,
+        Dict,
+        FrozenSet,
+        List,
+        NoReturn,
+        Optional,
+        Tuple,
+        Union,
+    )
+    from typing_extensions import Literal
+
+    _Memo = Dict[str, Union[int, Tuple[int, ...]]]
+
+
+# Bound once here, as `isinstance(obj, jnp.ndarray)` etc. happen on every check.
+_jnp_ndarray = jnp.ndarray
+_jnp_dtype = jnp.dtype
+_jax_tracer = jax.core.Tracer
+
 _array_name_format = "dtype_and_shape"
 
 
@@ -40,137 +67,273 @@ def set_array_name_format(value):
 
 _any_dtype = object()
 
-_anonymous_dim = object()
-_anonymous_variadic_dim = object()
+# Default for `dict.get` when looking up the memo etc. Cheaper than catching a
+# `KeyError`, and unlike `None` cannot be confused with a stored value.
+_MISS = object()
 
+# The kinds of dimension that may appear in a shape specification.
+_dim_anonymous = 0  # "_"
+_dim_fixed = 1  # e.g. "3"
+_dim_named = 2  # e.g. "batch"
+_dim_named_variadic = 3  # e.g. "*batch"
+_dim_anonymous_variadic = 4  # "..."
 
-class _NamedDim:
-    def __init__(self, name, broadcastable):
-        self.name = name
-        self.broadcastable = broadcastable
 
+class _Dim:
+    # `key` is the size for fixed dimensions, the name for named dimensions, and `None`
+    # for anonymous dimensions.
+    __slots__ = ("kind", "key", "broadcastable")
 
-class _NamedVariadicDim:
-    def __init__(self, name, broadcastable):
-        self.name = name
+    def __init__(self, kind: int, key: Union[None, int, str], broadcastable: bool):
+        self.kind = kind
+        self.key = key
         self.broadcastable = broadcastable
 
 
-class _FixedDim:
-    def __init__(self, size, broadcastable):
-        self.size = size
-        self.broadcastable = broadcastable
+# Dimensions are interned, so that equal dimensions are the same object. (Which in
+# particular lets `_make_check_dims` be cached on them.)
+_make_dim = ft.lru_cache(maxsize=None)(_Dim)
+_anonymous_dim = _make_dim(_dim_anonymous, None, False)
+_anonymous_variadic_dim = _make_dim(_dim_anonymous_variadic, None, False)
 
 
-_AbstractDimOrVariadicDim = Union[
-    Literal[_anonymous_dim],
-    Literal[_anonymous_variadic_dim],
-    _NamedDim,
-    _NamedVariadicDim,
-    _FixedDim,
-]
-_AbstractDim = Union[Literal[_anonymous_dim], _NamedDim, _FixedDim]
-
-
-def _check_dims(
-    cls_dims: List[_AbstractDim],
-    obj_shape: Tuple[int],
-    memo: Dict[str, Union[int, Tuple[int]]],
-):
-    assert len(cls_dims) == len(obj_shape)
-    for cls_dim, obj_size in zip(cls_dims, obj_shape):
-        if cls_dim is _anonymous_dim:
-            pass
-        elif cls_dim.broadcastable and obj_size == 1:
-            pass
-        elif type(cls_dim) is _FixedDim:
-            if cls_dim.size != obj_size:
-                return False
-        else:
-            assert type(cls_dim) is _NamedDim
-            try:
-                cls_size = memo[cls_dim.name]
-            except KeyError:
-                memo[cls_dim.name] = obj_size
-            else:
-                if cls_size != obj_size:
-                    return False
-    return True
+# Each of these returns the lines of source code checking the expression `obj_size`
+# against a non-variadic dimension `cls_dim`. They are indexed by the dimension's kind,
+# and assembled into a single function by `_make_check_dims`.
+
+
+def _anonymous_source(cls_dim: _Dim, obj_size: str) -> List[str]:
+    return []
+
+
+def _fixed_source(cls_dim: _Dim, obj_size: str) -> List[str]:
+    return [f"if {obj_size} != {cls_dim.key}:", "    return False"]
+
+
+def _named_source(cls_dim: _Dim, obj_size: str) -> List[str]:
+    name = repr(cls_dim.key)
+    return [
+        f"cls_size = overlay.get({name}, _MISS)",
+        "if cls_size is _MISS:",
+        f"    cls_size = memo.get({name}, _MISS)",
+        "    if cls_size is _MISS:",
+        f"        cls_size = overlay[{name}] = {obj_size}",
+        f"if cls_size != {obj_size}:",
+        "    return False",
+    ]
+
+
+_check_sources = (_anonymous_source, _fixed_source, _named_source)
+
+
+@ft.lru_cache(maxsize=None)
+def _make_check_dims(
+    cls_dims: Tuple[_Dim, ...], offset: int, check_ndim: bool
+) -> Callable[[Tuple[int, ...], _Memo, _Memo], bool]:
+    """Generates a function `check(obj_shape, memo, overlay) -> bool`, checking
+    `cls_dims` against `obj_shape[offset : offset + len(cls_dims)]`. If `check_ndim`
+    then this additionally checks that `len(obj_shape) == len(cls_dims)`.
+
+    Sizes are looked up in `overlay` and then `memo`; newly-bound sizes are written to
+    `overlay` only.
+
+    As `cls_dims` is fixed once the annotation has been parsed, we specialise the
+    check to them once here, rather than branching on the kind of each dimension
+    every time we perform a check. If not `check_ndim`, then the caller is responsible
+    for checking that `obj_shape` is long enough.
+
+    Cached, so that annotations sharing the same (parsed) dimensions, e.g.
+    `f32["a b"]` and `f64["a b"]`, also share the same generated function.
+    """
+    lines = ["def check(obj_shape, memo, overlay):"]
+    if check_ndim:
+        lines.append(f"    if len(obj_shape) != {len(cls_dims)}:")
+        lines.append("        return False")
+    # Fixed dimensions first, so that we reject mismatched shapes before touching the
+    # memo.
+    indexed_dims = sorted(
+        enumerate(cls_dims, offset), key=lambda x: x[1].kind == _dim_named
+    )
+    for index, cls_dim in indexed_dims:
+        obj_size = f"obj_shape[{index}]"
+        dim_lines = _check_sources[cls_dim.kind](cls_dim, obj_size)
+        if cls_dim.broadcastable:
+            dim_lines = [f"if {obj_size} != 1:"] + ["    " + x for x in dim_lines]
+        for line in dim_lines:
+            lines.append("    " + line)
+    lines.append("    return True")
+    namespace = {"_MISS": _MISS}
+    exec(compile("\n".join(lines), "<jaxtyping>", "exec"), namespace)
+    return namespace["check"]
+
+
+# Concrete (non-tracer) types that have previously passed
+# `isinstance(obj, jnp.ndarray)`. Checking `type(obj)` against these first lets us
+# skip `jnp.ndarray.__instancecheck__` in the common case of being passed the same few
+# array types over and over.
+_array_types = set()
+
+# Results of shape checks that do not depend on the memo, keyed on `(cls, obj.shape)`.
+# Bounded, with first-in-first-out eviction.
+_shape_check_cache: Dict[Tuple[type, Tuple[int, ...]], bool] = {}
+_shape_check_cache_size = 4096
 
 
 class _MetaAbstractArray(type):
     def __instancecheck__(cls, obj):
-        if not isinstance(obj, jnp.ndarray):
-            return False
-
-        if cls.dtypes is not _any_dtype and obj.dtype not in cls.dtypes:
+        obj_type = type(obj)
+        if obj_type not in _array_types:
+            if not isinstance(obj, _jnp_ndarray):
+                return False
+            # Tracers are excluded as whether they are arrays depends on their aval.
+            if not isinstance(obj, _jax_tracer):
+                _array_types.add(obj_type)
+
+        dtype = obj.dtype
+        if (
+            dtype is not cls._single_dtype
+            and cls.dtypes is not None
+            and dtype not in cls.dtypes
+        ):
             return False
 
-        if len(storage.memo_stack) == 0:
-            # `isinstance` happening outside any @jaxtyped decorators, e.g. at the
-            # global scope. In this case just create a temporary memo, since we're not
-            # going to be comparing against any stored values anyway.
-            memo = {}
-            temp_memo = True
-        else:
-            # Make a copy so we don't mutate the original memo during the shape check.
-            memo = storage.memo_stack[-1].copy()
-            temp_memo = False
-
-        if cls._check_shape(obj, memo):
+        memo = storage.current_memo
+        if memo is None or not cls._has_named_dims:
+            # Either `isinstance` is happening outside any @jaxtyped decorators, e.g.
+            # at the global scope, or there are no named dimensions to look up. In
+            # either case just use a temporary memo, since we're not going to be
+            # comparing against any stored values anyway. This means that the result
+            # depends only on the shape, so we can cache it.
+            key = (cls, obj.shape)
+            out = _shape_check_cache.get(key, _MISS)
+            if out is not _MISS:
+                return out
+            out = cls._check_shape(obj.shape, {}, {})
+            if len(_shape_check_cache) >= _shape_check_cache_size:
+                # Evict the oldest entry. (Dictionaries preserve insertion order.)
+                del _shape_check_cache[next(iter(_shape_check_cache))]
+            _shape_check_cache[key] = out
+            return out
+
+        # Record new bindings in a separate overlay, so that we don't mutate the memo
+        # if the shape check fails partway through.
+        overlay = {}
+        if cls._check_shape(obj.shape, memo, overlay):
             # We update the memo every time we successfully pass a shape check
-            if not temp_memo:
-                storage.memo_stack[-1] = memo
+            if overlay:
+                memo.update(overlay)
             return True
         else:
             return False
 
-    def _check_shape(cls, obj, memo):
-        if cls.index_variadic is None:
-            if obj.ndim != len(cls.dims):
-                return False
-            return _check_dims(cls.dims, obj.shape, memo)
-        else:
-            if obj.ndim < len(cls.dims) - 1:
-                return False
-            i = cls.index_variadic
-            j = -(len(cls.dims) - i - 1)
-            if j == 0:
-                j = None
-            if not _check_dims(cls.dims[:i], obj.shape[:i], memo):
-                return False
-            if j is not None and not _check_dims(cls.dims[j:], obj.shape[j:], memo):
-                return False
-            variadic_dim = cls.dims[i]
-            if variadic_dim is not _anonymous_variadic_dim:
-                variadic_name = variadic_dim.name
-                try:
-                    variadic_shape = memo[variadic_name]
-                except KeyError:
-                    memo[variadic_name] = obj.shape[i:j]
-                else:
-                    if variadic_dim.broadcastable:
-                        new_variadic_shape = []
-                        obj_shape = obj.shape[i:j]
-                        if len(variadic_shape) != len(obj_shape):
-                            return False
-                        for old_size, new_size in zip(variadic_shape, obj_shape):
-                            if old_size == 1:
-                                new_variadic_shape.append(new_size)
-                            else:
-                                if new_size != 1 and old_size != new_size:
-                                    return False
-                                new_variadic_shape.append(old_size)
-                        memo[variadic_name] = tuple(new_variadic_shape)
+    # Used as `_check_shape` for array classes with a variadic dimension.
+    def _check_variadic_shape(cls, obj_shape, memo, overlay):
+        if len(obj_shape) < cls._ndim:
+            return False
+        if not cls._check_prefix(obj_shape, memo, overlay):
+            return False
+        if not cls._check_suffix(obj_shape, memo, overlay):
+            return False
+        variadic_dim = cls._variadic_dim
+        if variadic_dim.kind == _dim_named_variadic:
+            obj_variadic_shape = obj_shape[cls._variadic_slice]
+            variadic_name = variadic_dim.key
+            variadic_shape = overlay.get(variadic_name, _MISS)
+            if variadic_shape is _MISS:
+                variadic_shape = memo.get(variadic_name, _MISS)
+                if variadic_shape is _MISS:
+                    overlay[variadic_name] = obj_variadic_shape
+                    return True
+            if variadic_dim.broadcastable:
+                if variadic_shape == obj_variadic_shape:
+                    # Common case; nothing to broadcast.
+                    return True
+                if len(variadic_shape) != len(obj_variadic_shape):
+                    return False
+                new_variadic_shape = []
+                for old_size, new_size in zip(variadic_shape, obj_variadic_shape):
+                    if old_size == 1:
+                        new_variadic_shape.append(new_size)
                     else:
-                        return variadic_shape == obj.shape[i:j]
-            return True
+                        if new_size != 1 and old_size != new_size:
+                            return False
+                        new_variadic_shape.append(old_size)
+                overlay[variadic_name] = tuple(new_variadic_shape)
+            else:
+                return variadic_shape == obj_variadic_shape
+        return True
 
 
 class AbstractArray(metaclass=_MetaAbstractArray):
-    dtypes: List[jnp.dtype]
-    dims: List[_AbstractDimOrVariadicDim]
-    index_variadic: Optional[int]
+    # Everything is stored on the (generated) subclasses themselves; instances carry
+    # nothing.
+    __slots__ = ()
+
+    # `None` if any dtype is allowed.
+    dtypes: ClassVar[Optional[FrozenSet[jnp.dtype]]]
+    # If exactly one dtype is allowed, then that dtype; else `None`. NumPy (and so JAX)
+    # canonicalises dtype objects, so in practice an array of this dtype will have
+    # `obj.dtype is _single_dtype`, which is cheaper to check than `obj.dtype in
+    # dtypes`. This is only a fast path: we fall back to the latter if it fails.
+    _single_dtype: ClassVar[Optional[jnp.dtype]]
+    dims: ClassVar[Tuple[_Dim, ...]]
+    index_variadic: ClassVar[Optional[int]]
+    # `_check_shape(obj_shape, memo, overlay) -> bool`. If there is no variadic
+    # dimension then this is generated by `_make_check_dims`; otherwise it is
+    # `_MetaAbstractArray._check_variadic_shape`, which uses `_check_prefix` and
+    # `_check_suffix` (also generated) to check the dimensions either side of the
+    # variadic dimension.
+    _check_shape: ClassVar[Callable[[Tuple[int, ...], _Memo, _Memo], bool]]
+    _check_prefix: ClassVar[Optional[Callable]]
+    _check_suffix: ClassVar[Optional[Callable]]
+    # Whether there are any named (possibly variadic) dimensions, i.e. whether the
+    # check depends on the memo.
+    _has_named_dims: ClassVar[bool]
+    # The number of non-variadic dimensions.
+    _ndim: ClassVar[int]
+    # If there is a variadic dimension: that dimension, and the slice of the shape it
+    # matches against.
+    _variadic_dim: ClassVar[Optional[_Dim]]
+    _variadic_slice: ClassVar[Optional[slice]]
+
+
+# Shared between all dtypes, so that e.g. `f32["a b"]` and `f64["a b"]` only parse
+# "a b" once, and end up with the same dimension objects.
+@ft.lru_cache(maxsize=None)
+def _parse_dim_str(
+    dim_str: str,
+) -> Tuple[Tuple[_Dim, ...], Optional[int]]:
+    dims = []
+    index_variadic = None
+    for index, elem in enumerate(dim_str.split()):
+        if "," in elem:
+            # Common mistake
+            raise ValueError("Dimensions should be separated with spaces, not commas")
+        broadcastable = False
+        if elem.endswith("#"):
+            broadcastable = True
+            elem = elem[:-1]
+        try:
+            elem = int(elem)
+        except ValueError:
+            if elem == "_":
+                elem = _anonymous_dim
+            elif elem == "...":
+                if index_variadic is not None:
+                    raise ValueError("Cannot have multiple variadic dimensions")
+                index_variadic = index
+                elem = _anonymous_variadic_dim
+            elif elem[0] == "*":
+                if index_variadic is not None:
+                    raise ValueError("Cannot have multiple variadic dimensions")
+                index_variadic = index
+                elem = _make_dim(_dim_named_variadic, elem[1:], broadcastable)
+            else:
+                elem = _make_dim(_dim_named, elem, broadcastable)
+        else:
+            elem = _make_dim(_dim_fixed, elem, broadcastable)
+        dims.append(elem)
+    return tuple(dims), index_variadic
 
 
 class _MetaAbstractDtype(type):
@@ -187,49 +350,52 @@ class _MetaAbstractDtype(type):
             raise ValueError(
                 "Shape specification must be a string. Axes should be separated with spaces."
             )
-        dims = []
-        index_variadic = None
-        for index, elem in enumerate(dim_str.split()):
-            if "," in elem:
-                # Common mistake
-                raise ValueError(
-                    "Dimensions should be separated with spaces, not commas"
-                )
-            broadcastable = False
-            if elem.endswith("#"):
-                broadcastable = True
-                elem = elem[:-1]
-            try:
-                elem = int(elem)
-            except ValueError:
-                if elem == "_":
-                    elem = _anonymous_dim
-                elif elem == "...":
-                    if index_variadic is not None:
-                        raise ValueError("Cannot have multiple variadic dimensions")
-                    index_variadic = index
-                    elem = _anonymous_variadic_dim
-                elif elem[0] == "*":
-                    if index_variadic is not None:
-                        raise ValueError("Cannot have multiple variadic dimensions")
-                    index_variadic = index
-                    elem = _NamedVariadicDim(elem[1:], broadcastable)
-                else:
-                    elem = _NamedDim(elem, broadcastable)
-            else:
-                elem = _FixedDim(elem, broadcastable)
-            dims.append(elem)
+        dims, index_variadic = _parse_dim_str(dim_str)
         if _array_name_format == "dtype_and_shape":
             name = f"{cls.__name__}['{dim_str}']"
         elif _array_name_format == "array":
             name = "Array"
         else:
             raise ValueError(f"array_name_format {_array_name_format} not recognised")
-        return _MetaAbstractArray(
+        if index_variadic is None:
+            ndim = len(dims)
+            check_shape = _make_check_dims(dims, 0, True)
+            check_prefix = check_suffix = None
+            variadic_dim = variadic_slice = None
+        else:
+            ndim = len(dims) - 1
+            prefix_dims = dims[:index_variadic]
+            suffix_dims = dims[index_variadic + 1 :]
+            check_shape = None
+            check_prefix = _make_check_dims(prefix_dims, 0, False)
+            check_suffix = _make_check_dims(suffix_dims, -len(suffix_dims), False)
+            variadic_dim = dims[index_variadic]
+            # `None` rather than `-0` if there are no dimensions after the variadic one.
+            variadic_slice = slice(len(prefix_dims), -len(suffix_dims) or None)
+        out = _MetaAbstractArray(
             name,
             (AbstractArray,),
-            dict(dtypes=cls.dtypes, dims=dims, index_variadic=index_variadic),
+            dict(
+                __slots__=(),
+                dtypes=cls.dtypes,
+                _single_dtype=cls._single_dtype,
+                dims=dims,
+                index_variadic=index_variadic,
+                _check_shape=check_shape,
+                _check_prefix=check_prefix,
+                _check_suffix=check_suffix,
+                _has_named_dims=any(
+                    dim.kind in (_dim_named, _dim_named_variadic) for dim in dims
+                ),
+                _ndim=ndim,
+                _variadic_dim=variadic_dim,
+                _variadic_slice=variadic_slice,
+            ),
         )
+        if index_variadic is not None:
+            # Decided once here, rather than branching on every check.
+            out._check_shape = out._check_variadic_shape
+        return out
 
 
 class AbstractDtype(metaclass=_MetaAbstractDtype):
@@ -245,11 +411,19 @@ class AbstractDtype(metaclass=_MetaAbstractDtype):
         super().__init_subclass__(**kwargs)
 
         dtypes = cls.dtypes
-        if dtypes is not _any_dtype:
-            if not isinstance(dtypes, list):
+        # `None` is the normalised form of `_any_dtype`, inherited by e.g. subclasses of
+        # `Array`.
+        if dtypes is _any_dtype or dtypes is None:
+            cls.dtypes = None
+        else:
+            # Subclasses of existing dtypes inherit an already-normalised frozenset.
+            if not isinstance(dtypes, (list, tuple, set, frozenset)):
                 dtypes = [dtypes]
-            dtypes = [jnp.dtype(d) for d in dtypes]
-        cls.dtypes = dtypes
+            cls.dtypes = frozenset(_jnp_dtype(d) for d in dtypes)
+        if cls.dtypes is not None and len(cls.dtypes) == 1:
+            [cls._single_dtype] = cls.dtypes
+        else:
+            cls._single_dtype = None
 
 
 _bool = "bool"
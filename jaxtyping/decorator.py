@@ -22,17 +22,19 @@ import threading
 
 
 storage = threading.local()
-storage.memo_stack = []
+# The memo of the innermost @jaxtyped function currently running, or `None` if there
+# isn't one. Enclosing memos are kept on the Python call stack, in `wrapper` below.
+storage.current_memo = None
 
 
 def jaxtyped(fn):
     @ft.wraps(fn)
     def wrapper(*args, **kwargs):
-        memo = {}
-        storage.memo_stack.append(memo)
+        prev_memo = storage.current_memo
+        storage.current_memo = {}
         try:
             return fn(*args, **kwargs)
         finally:
-            storage.memo_stack.pop()
+            storage.current_memo = prev_memo
 
     return wrapper
@@ -21,7 +21,7 @@ import jax.numpy as jnp
 import jax.random as jr
 import pytest
 
-from jaxtyping import Array, f, f32, jaxtyped
+from jaxtyping import Array, array_types, f, f32, i32, jaxtyped
 
 from .helpers import ParamError, ReturnError
 
@@ -140,6 +140,49 @@ def test_isinstance(typecheck, getkey):
     g(jr.normal(getkey(), (2, 3)))
 
 
+def test_isinstance_no_jaxtyped(getkey):
+    x = jr.normal(getkey(), (2, 3))
+    # Check twice, to exercise the cache.
+    for _ in range(2):
+        assert isinstance(x, f32["b c"])
+        assert isinstance(x, f32["2 c"])
+        assert not isinstance(x, f32["3 c"])
+        assert not isinstance(x, f32["b"])
+        assert not isinstance(x, i32["b c"])
+        assert not isinstance(x.tolist(), f32["b c"])
+    assert array_types._shape_check_cache[(f32["b c"], (2, 3))] is True
+    assert array_types._shape_check_cache[(f32["3 c"], (2, 3))] is False
+
+
+def test_shape_check_cache_bounded(monkeypatch):
+    monkeypatch.setattr(array_types, "_shape_check_cache", {})
+    monkeypatch.setattr(array_types, "_shape_check_cache_size", 8)
+    cls = f32["n"]
+    for size in range(20):
+        assert isinstance(jnp.zeros(size), cls)
+        assert len(array_types._shape_check_cache) <= 8
+    # First-in-first-out: only the most recent shapes remain.
+    assert list(array_types._shape_check_cache) == [
+        (cls, (size,)) for size in range(12, 20)
+    ]
+
+
+def test_repeated_name(typecheck, getkey):
+    @jaxtyped
+    @typecheck
+    def g(x: f32["n n"], y: f32["m 3 n"]):
+        pass
+
+    a = jr.normal(getkey(), (2, 2))
+    b = jr.normal(getkey(), (4, 3, 2))
+    c = jr.normal(getkey(), (4, 3, 3))
+    g(a, b)
+    with pytest.raises(ParamError):
+        g(b[0], b)
+    with pytest.raises(ParamError):
+        g(a, c)
+
+
 def test_fixed(typecheck, getkey):
     @jaxtyped
     @typecheck
@@ -327,6 +370,30 @@ def test_broadcast_variadic_named(typecheck, getkey):
         g(o, a)
 
 
+def test_subclass_dtype(getkey):
+    class Sub32(f32):
+        pass
+
+    class SubFloat(f):
+        pass
+
+    x = jr.normal(getkey(), (2, 3))
+    assert isinstance(x, Sub32["a b"])
+    assert isinstance(x, SubFloat["a b"])
+    assert not isinstance(x.astype(jnp.int32), Sub32["a b"])
+    assert not isinstance(x.astype(jnp.int32), SubFloat["a b"])
+
+
+def test_subclass_any_dtype(getkey):
+    class SubArray(Array):
+        pass
+
+    x = jr.normal(getkey(), (2, 3))
+    assert isinstance(x, SubArray["a b"])
+    assert isinstance(x.astype(jnp.int32), SubArray["a b"])
+    assert isinstance(x.astype(jnp.bool_), SubArray["a b"])
+
+
 def test_no_commas(typecheck, getkey):
     with pytest.raises(ValueError):
         f32["foo, bar"]